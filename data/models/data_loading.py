@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+def load_csv(csv_path, column_types):
+    """
+    Load the columns named in column_types from a CSV using the Arrow CSV reader.
+    - Clean files are parsed straight into column_types.
+    - If a cell does not parse, the columns are re-read as strings and coerced
+      with pandas, so malformed values become NaN/NaT and are dropped in preprocessing.
+    """
+    try:
+        convert_options = pacsv.ConvertOptions(column_types=column_types, include_columns=list(column_types))
+        return pacsv.read_csv(csv_path, convert_options=convert_options).to_pandas()
+    except pa.ArrowInvalid:
+        pass
+    convert_options = pacsv.ConvertOptions(
+        column_types={col: pa.string() for col in column_types}, include_columns=list(column_types)
+    )
+    df = pacsv.read_csv(csv_path, convert_options=convert_options).to_pandas()
+    for col, arrow_type in column_types.items():
+        if pa.types.is_timestamp(arrow_type):
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+        elif pa.types.is_floating(arrow_type):
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(arrow_type.to_pandas_dtype())
+        else:
+            # Integer columns stay float until preprocessing drops the missing values
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    return df
+
+def parquet_cache_path(csv_path, script_path):
+    """
+    Path of the Parquet cache of csv_path's preprocessed frame.
+    - The cache sits next to the CSV, tagged with the name of the script that preprocessed it.
+    """
+    script_name = os.path.splitext(os.path.basename(script_path))[0]
+    return f"{os.path.splitext(csv_path)[0]}.{script_name}.parquet"
+
+def cache_is_fresh(csv_path, script_path, extra_sources=()):
+    """
+    Whether the Parquet cache of csv_path can be reused.
+    - It must be newer than the CSV, the script, this module and any extra_sources
+      (other files the preprocessing reads).
+    """
+    parquet_path = parquet_cache_path(csv_path, script_path)
+    sources = (csv_path, script_path, __file__, *extra_sources)
+    newest_source = max(os.path.getmtime(path) for path in sources)
+    return os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= newest_source
+
+def write_parquet(tables, parquet_path):
+    """
+    Write an iterable of Arrow tables sharing one schema to a single Parquet file.
+    - The tables go to a temporary sibling file that replaces parquet_path only once
+      all of them are written, so an interrupted write never leaves a partial cache
+      that looks fresh.
+    - Nothing is written if tables is empty.
+    """
+    tmp_path = parquet_path + ".tmp"
+    writer = None
+    try:
+        for table in tables:
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression="zstd")
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(tmp_path, parquet_path)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def cached_load(csv_path, preprocess_fn, column_types, script_path, columns=None, extra_sources=()):
+    """
+    Load a CSV and return its preprocessed frame, caching the result as Parquet.
+    - The CSV is parsed by load_csv with column_types (column name to Arrow type).
+    - The cache is reused while cache_is_fresh holds for script_path and extra_sources.
+    - Only the requested columns are read back from the cache.
+    """
+    parquet_path = parquet_cache_path(csv_path, script_path)
+    if cache_is_fresh(csv_path, script_path, extra_sources):
+        return pq.read_table(parquet_path, columns=columns).to_pandas()
+
+    df = preprocess_fn(load_csv(csv_path, column_types))
+    write_parquet([pa.Table.from_pandas(df, preserve_index=False)], parquet_path)
+    return df if columns is None else df[columns]
+
+def format_timestamps(index):
+    """
+    Format a DatetimeIndex as an ndarray of 'YYYY-MM-DD HH:MM:SS' strings with one vectorized numpy call.
+    """
+    stamps = np.datetime_as_string(index.values.astype("datetime64[s]"), unit="s")
+    return np.char.replace(stamps, "T", " ")
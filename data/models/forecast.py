@@ -2,8 +2,8 @@ import os
 import pandas as pd
 import json
 import numpy as np
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import StandardScaler
+import pyarrow as pa
+from data_loading import cached_load, format_timestamps
 
 # Define base directory relative to this script's location
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../"))
@@ -22,113 +22,145 @@ FORECAST_CONFIG = {
     "228": {"pollutant": "PM2.5", "start": "2023-12-01 00:00:00", "end": "2023-12-31 23:00:00"}
 }
 
+# Column types for measurement_data.csv, parsed directly by the Arrow CSV reader
+POLLUTANT_COLS = ["SO2", "NO2", "O3", "CO", "PM10", "PM2.5"]
+MEASUREMENT_COLUMN_TYPES = {
+    "Measurement date": pa.timestamp("s"),
+    "Station code": pa.int16(),
+    **{col: pa.float32() for col in POLLUTANT_COLS},
+}
+
+# Regression inputs; each station's coefficient block is [intercept, *FEATURES]
+FEATURES = ["hour", "day_of_week", "month"]
+N_COEFS = len(FEATURES) + 1
+
 def preprocess_measurement_data(df):
     """
     Preprocess and clean measurement data.
-    - Drops duplicates and rows with missing Measurement date or pollutant values.
-    - Converts pollutant columns and 'Station code' to numeric types.
-    - Ensures Measurement date is datetime.
+    - Drops rows with missing Measurement date or pollutant values.
+    - Drops rows with a missing 'Station code'.
+    - Drops duplicate readings, keyed on 'Station code' and Measurement date only.
+    Column types are already set by load_csv, which also turns malformed cells into
+    NaN/NaT, so no coercion is needed here.
+    Rows are filtered before deduplication so fewer rows are hashed.
     """
-    df.drop_duplicates(inplace=True)
     df = df.dropna(subset=["Measurement date"])
+    df = df.dropna(subset=POLLUTANT_COLS)
     
-    # List of pollutant columns to clean
-    pollutant_cols = ["SO2", "NO2", "O3", "CO", "PM10", "PM2.5"]
-    for col in pollutant_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-    df.dropna(subset=pollutant_cols, inplace=True)
-    
-    # Ensure 'Station code' is numeric and drop rows with invalid values
+    # Drop rows with invalid station codes, restoring the narrow integer type
+    # that missing values would have widened to float
     if "Station code" in df.columns:
-        df["Station code"] = pd.to_numeric(df["Station code"], errors="coerce")
-        df.dropna(subset=["Station code"], inplace=True)
-    
-    # Ensure Measurement date is a datetime object
-    if not pd.api.types.is_datetime64_any_dtype(df["Measurement date"]):
-        df["Measurement date"] = pd.to_datetime(df["Measurement date"], errors="coerce")
+        df = df.dropna(subset=["Station code"]).astype({"Station code": "int16"})
     
-    return df
+    return df.drop_duplicates(subset=["Station code", "Measurement date"])
 
-def feature_engineering(df):
+def feature_engineering(dates):
     """
-    Create additional time-based features for forecasting:
+    Create time-based features for forecasting as an (n, 3) int8 array:
     - hour: Hour of day (0-23)
     - day_of_week: Day of week (0=Monday, 6=Sunday)
     - month: Month (1-12)
+    The features are computed straight from the date column, so the source frame is never copied.
     """
-    df = df.copy()
-    df["hour"] = df["Measurement date"].dt.hour
-    df["day_of_week"] = df["Measurement date"].dt.dayofweek
-    df["month"] = df["Measurement date"].dt.month
-    return df
+    dates = pd.Series(dates)
+    features = np.empty((len(dates), len(FEATURES)), dtype=np.int8)
+    features[:, 0] = dates.dt.hour
+    features[:, 1] = dates.dt.dayofweek
+    features[:, 2] = dates.dt.month
+    return features
 
-def forecast_station_improved(df, station_code, pollutant, forecast_period):
-    # Filter historical data for the given station
-    df_station = df[df["Station code"] == int(station_code)].copy()
-    if df_station.empty or pollutant not in df_station.columns:
-        # If no data is available, return a forecast of zeros
-        return {ts: 0.0 for ts in forecast_period}
-    
-    # Apply feature engineering to create time-based features
-    df_station = feature_engineering(df_station)
-    
-    # Define features and target
-    features = ["hour", "day_of_week", "month"]
-    X = df_station[features]
-    y = df_station[pollutant]
-    
-    # Normalize features using StandardScaler
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
-    
-    # Train a linear regression model on historical data
-    model = LinearRegression()
-    model.fit(X_scaled, y)
-    
-    # Prepare forecast features for each timestamp in forecast_period
-    forecast_timestamps = pd.to_datetime(forecast_period)
-    forecast_df = pd.DataFrame({"Measurement date": forecast_timestamps})
-    forecast_df = feature_engineering(forecast_df)
-    X_forecast = forecast_df[features]
-    X_forecast_scaled = scaler.transform(X_forecast)
+def design_matrix(features, block, n_blocks, center, scale):
+    """
+    Build least-squares design rows for one station's feature_engineering output.
+    - Columns come in blocks of [intercept, hour, day_of_week, month], one per station.
+    - Features are standardized with the station's training center and scale, as a
+      StandardScaler would, so a feature that is constant in the history (e.g. a
+      single month) becomes a zero column and takes no weight from the intercept.
+    - Only this station's block is filled, so the stacked rows of all stations form a
+      block-diagonal system whose solution equals a separate regression per station.
+    """
+    X = np.zeros((len(features), n_blocks * N_COEFS))
+    X[:, block * N_COEFS] = 1.0
+    X[:, block * N_COEFS + 1:(block + 1) * N_COEFS] = (features - center) / scale
+    return X
+
+def build_period_cache(config):
+    """
+    Precompute what each configured forecast period needs, keyed by station:
+    - timestamps: output keys as 'YYYY-MM-DD HH:MM:SS' strings
+    - features: the feature_engineering array for the period
+    The periods are fixed, so this runs once at import time.
+    """
+    cache = {}
+    for station, station_config in config.items():
+        index = pd.date_range(start=station_config["start"], end=station_config["end"], freq="H")
+        cache[station] = {"timestamps": format_timestamps(index).tolist(), "features": feature_engineering(index)}
+    return cache
+
+PERIOD_CACHE = build_period_cache(FORECAST_CONFIG)
+
+def forecast_stations(df, station_rows, forecast_periods):
+    """
+    Fit a linear model for every configured station in a single least-squares solve.
+    - forecast_periods maps each station to its build_period_cache entry.
+    - Each station regresses its configured pollutant on hour, day_of_week and month.
+    - All forecasts come from one product of the stacked forecast rows and coefficients.
+    - Stations without history keep all-zero coefficients and forecast zeros.
+    """
+    stations = list(forecast_periods)
+    n_blocks = len(stations)
+    X_parts, y_parts, X_forecast_parts = [], [], []
+    for block, station in enumerate(stations):
+        pollutant = FORECAST_CONFIG[station]["pollutant"]
+        # Historical rows for this station, located by the precomputed group positions;
+        # only the two columns needed are gathered, never the whole station frame
+        rows = station_rows.get(int(station), [])
+        center, scale = 0.0, 1.0
+        if len(rows) and pollutant in df.columns:
+            features = feature_engineering(df["Measurement date"].iloc[rows])
+            # Center on the training means and scale by the standard deviations,
+            # leaving constant features at scale 1 (they center to zero)
+            center = features.mean(axis=0)
+            scale = features.std(axis=0)
+            scale[scale == 0] = 1.0
+            X_parts.append(design_matrix(features, block, n_blocks, center, scale))
+            y_parts.append(df[pollutant].to_numpy()[rows].astype(np.float64))
+        
+        # Forecast features for each timestamp in the station's forecast period
+        X_forecast_parts.append(design_matrix(forecast_periods[station]["features"], block, n_blocks, center, scale))
     
-    # Predict pollutant values using the trained model
-    predictions = model.predict(X_forecast_scaled)
+    coefs = np.zeros(n_blocks * N_COEFS)
+    if X_parts:
+        coefs, *_ = np.linalg.lstsq(np.vstack(X_parts), np.concatenate(y_parts), rcond=None)
     # Clip negative predictions to 0 (assuming negative pollutant values are unrealistic)
-    predictions = np.clip(predictions, 0, None)
+    predictions = np.clip(np.vstack(X_forecast_parts) @ coefs, 0, None)
     
-    # Build forecast dictionary with timestamp strings and predicted values rounded to 2 decimals
-    forecast = {ts: round(float(pred), 2) for ts, pred in zip(forecast_period, predictions)}
-    return forecast
+    # Build forecast dictionaries with timestamp strings and predicted values rounded to 2 decimals
+    forecasts = {}
+    offsets = np.cumsum([len(forecast_periods[station]["timestamps"]) for station in stations])[:-1]
+    for station, station_preds in zip(stations, np.split(predictions.round(2), offsets)):
+        forecasts[station] = dict(zip(forecast_periods[station]["timestamps"], station_preds.tolist()))
+    return forecasts
 
 def main():
-    # Load measurement data with proper date parsing
+    # Load preprocessed measurement data, reading only the columns the forecasts use
+    columns = ["Station code", "Measurement date"]
+    columns += list(dict.fromkeys(config["pollutant"] for config in FORECAST_CONFIG.values()))
     try:
-        df_measure = pd.read_csv(MEASUREMENT_FILE, parse_dates=["Measurement date"])
+        df_measure = cached_load(MEASUREMENT_FILE, preprocess_measurement_data, MEASUREMENT_COLUMN_TYPES, __file__, columns=columns)
     except Exception as e:
         print("Error loading measurement data:", e)
         return
     
-    # Preprocess the measurement data
-    df_measure = preprocess_measurement_data(df_measure)
-    
-    result = {"target": {}}
+    # Group rows by station once so each station's rows are sliced by position
+    # instead of rescanning the whole frame
+    station_rows = df_measure.groupby("Station code").indices
     
-    # Loop through each forecast configuration
-    for station, config in FORECAST_CONFIG.items():
-        pollutant = config["pollutant"]
-        start = config["start"]
-        end = config["end"]
-        # Generate forecast timestamps with hourly frequency
-        forecast_period = pd.date_range(start=start, end=end, freq="H").strftime("%Y-%m-%d %H:%M:%S").tolist()
-        # Get the forecast for this station and pollutant using the improved model
-        station_forecast = forecast_station_improved(df_measure, station, pollutant, forecast_period)
-        result["target"][station] = station_forecast
+    result = {"target": forecast_stations(df_measure, station_rows, PERIOD_CACHE)}
     
-    # Write predictions to predictions_task_2.json
+    # Write predictions to predictions_task_2.json, compactly since it is machine-consumed
     with open(OUTPUT_FILE, "w") as f:
-        json.dump(result, f, indent=2)
+        json.dump(result, f, separators=(",", ":"))
     print("Forecast predictions for Task 2 have been written to", OUTPUT_FILE)
 
 if __name__ == "__main__":
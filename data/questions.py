@@ -2,6 +2,11 @@ import os
 import pandas as pd
 import numpy as np
 import json
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+from models.data_loading import cached_load, cache_is_fresh, parquet_cache_path, write_parquet
 
 # Define base directory relative to this script's location
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
@@ -9,6 +14,25 @@ MEASUREMENT_FILE = os.path.join(BASE_DIR, "data/raw/measurement_data.csv")
 INSTRUMENT_FILE = os.path.join(BASE_DIR, "data/raw/instrument_data.csv")
 POLLUTANT_FILE = os.path.join(BASE_DIR, "data/raw/pollutant_data.csv")
 
+# Rows per measurement batch when streaming the preprocessed data
+CHUNK_SIZE = 500_000
+
+# Only the columns the questions use are parsed from the CSVs, with their types
+# declared up front so the parser skips the inference pass
+POLLUTANT_COLS = ["SO2", "NO2", "O3", "CO", "PM10", "PM2.5"]
+MEASUREMENT_CSV_OPTIONS = {
+    "usecols": ["Measurement date", "Station code"] + POLLUTANT_COLS,
+    "dtype": {"Station code": "Int16", **{col: "float32" for col in POLLUTANT_COLS}},
+}
+# The instrument CSV is read in full, so it goes through the Arrow CSV reader
+INSTRUMENT_COLUMN_TYPES = {
+    "Measurement date": pa.timestamp("s"),
+    "Station code": pa.int16(),
+    "Item code": pa.int16(),
+    "Instrument status": pa.int8(),
+}
+POLLUTANT_INFO_COLUMNS = {"Item code", "Item name", "Good", "Normal", "Bad"}
+
 def get_season(month):
     if month in [12, 1, 2]:
         return "1"  # Winter
@@ -19,141 +43,301 @@ def get_season(month):
     else:
         return "4"  # Autumn
 
+# Season number minus one per month (index 0 unused), so per-season totals are
+# a bincount over the month array
+SEASON_INDEX_BY_MONTH = np.array([0] + [int(get_season(month)) - 1 for month in range(1, 13)], dtype=np.intp)
+
 def preprocess_measurement_data(df):
-    # Drop duplicates and rows missing Measurement date
-    df = df.drop_duplicates().dropna(subset=["Measurement date"])
-    # Convert pollutant columns to numeric
-    pollutant_cols = ["SO2", "NO2", "O3", "CO", "PM10", "PM2.5"]
-    for col in pollutant_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-    # Convert 'Station code' to numeric and drop rows where conversion fails
-    df["Station code"] = pd.to_numeric(df["Station code"], errors="coerce")
-    df = df.dropna(subset=["Station code"])
-    # Ensure Measurement date is a datetime
-    df["Measurement date"] = pd.to_datetime(df["Measurement date"], errors="coerce")
-    return df
+    # Drop rows missing Measurement date or Station code first, so later steps
+    # touch fewer rows; pollutant and station types are set by MEASUREMENT_CSV_OPTIONS
+    df = df.dropna(subset=["Measurement date", "Station code"])
+    # read_csv already parses Measurement date; only coerce it if that failed
+    if not pd.api.types.is_datetime64_any_dtype(df["Measurement date"]):
+        df["Measurement date"] = pd.to_datetime(df["Measurement date"], errors="coerce")
+    # Station code no longer needs the nullable type once missing values are gone
+    df = df.astype({"Station code": "int16"})
+    # Drop duplicate readings; station and timestamp identify a row, so only
+    # these two narrow columns are hashed
+    return df.drop_duplicates(subset=["Station code", "Measurement date"])
 
 def preprocess_instrument_data(df):
-    # Drop duplicates and rows missing critical columns
+    # Drop duplicates and rows missing critical columns; load_csv has already typed
+    # the columns and turned malformed cells into missing values
     df = df.drop_duplicates().dropna(subset=["Measurement date", "Station code", "Instrument status"])
-    # Trim whitespace in Instrument status if necessary
-    if df["Instrument status"].dtype == object:
-        df["Instrument status"] = df["Instrument status"].str.strip()
-    # Convert columns to numeric
-    df["Station code"] = pd.to_numeric(df["Station code"], errors="coerce")
-    df["Instrument status"] = pd.to_numeric(df["Instrument status"], errors="coerce")
-    return df.dropna(subset=["Station code", "Instrument status"])
-
-def load_pollutant_mapping():
+    # Restore the narrow types that missing values would have widened to float;
+    # Item code may hold missing values, so it keeps its type
+    return df.astype({"Station code": "int16", "Instrument status": "int8"})
+
+def station_time_keys(df):
+    # Pack Station code and Measurement date (to the second) into one int64 per
+    # row, so (station, timestamp) pairs can be sorted and matched as plain integers
+    seconds = df["Measurement date"].to_numpy().astype("datetime64[s]").astype(np.int64)
+    return (seconds << 16) | (df["Station code"].to_numpy().astype(np.int64) & 0xFFFF)
+
+def sorted_isin(keys, sorted_keys):
+    # Membership of keys in a sorted array of unique keys, by binary search
+    pos = np.searchsorted(sorted_keys, keys)
+    found = np.zeros(len(keys), dtype=bool)
+    inside = pos < len(sorted_keys)
+    found[inside] = sorted_keys[pos[inside]] == keys[inside]
+    return found
+
+def add_sorted_run(runs, keys):
+    # Add a sorted array of unique keys to a list of sorted runs. Like a binary
+    # counter, the last two runs are merged while the newer is at least as long,
+    # so there are O(log n) runs and each key is copied O(log n) times in total
+    runs.append(keys)
+    while len(runs) > 1 and len(runs[-2]) <= len(runs[-1]):
+        newer = runs.pop()
+        older = runs.pop()
+        runs.append(np.insert(older, np.searchsorted(older, newer), newer))
+
+def in_sorted_runs(keys, runs):
+    # Membership of keys in any of the sorted runs
+    found = np.zeros(len(keys), dtype=bool)
+    for run in runs:
+        found |= sorted_isin(keys, run)
+    return found
+
+def preprocessed_chunks(csv_path, preprocess_fn, csv_options):
+    # Parse and preprocess the CSV CHUNK_SIZE rows at a time, yielding Arrow tables,
+    # so building the cache never holds the whole file's rows. preprocess_fn
+    # deduplicates within a chunk; rows whose station and timestamp repeat an
+    # earlier chunk are dropped here. That needs one int64 key (8 bytes) per row
+    # kept so far, held in sorted runs (see add_sorted_run) rather than one array
+    # recopied on every chunk.
+    seen_runs = []
+    chunks = pd.read_csv(csv_path, parse_dates=["Measurement date"], chunksize=CHUNK_SIZE, **csv_options)
+    for chunk in chunks:
+        df = preprocess_fn(chunk)
+        keys = station_time_keys(df)
+        is_new = ~in_sorted_runs(keys, seen_runs)
+        df = df[is_new]
+        add_sorted_run(seen_runs, np.sort(keys[is_new]))
+        yield pa.Table.from_pandas(df, preserve_index=False)
+
+def iter_cached_batches(csv_path, preprocess_fn, csv_options, columns=None, batch_size=CHUNK_SIZE):
+    # Stream the requested columns of the cached preprocessed frame in batches of
+    # at most batch_size rows. A missing or stale cache is rebuilt chunk by chunk
+    # first; the rebuild holds one chunk of rows plus 8 bytes of dedup key per row,
+    # and reading the cache back holds one batch
+    parquet_path = parquet_cache_path(csv_path, __file__)
+    if not cache_is_fresh(csv_path, __file__):
+        write_parquet(preprocessed_chunks(csv_path, preprocess_fn, csv_options), parquet_path)
+    parquet_file = pq.ParquetFile(parquet_path)
+    batches = parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+    return (batch.to_pandas() for batch in batches)
+
+def merge_moments(total, part):
+    # Combine per-group (count, mean, m2) moments of two partitions of the data
+    # (Chan et al.'s parallel form of Welford's algorithm); m2 is the sum of
+    # squared deviations from the mean
+    part = part.reindex(total.index, fill_value=0)
+    count = total['count'] + part['count']
+    delta = part['mean'] - total['mean']
+    weight = (part['count'] / count).fillna(0)
+    return pd.DataFrame({
+        'count': count,
+        'mean': total['mean'] + delta * weight,
+        'm2': total['m2'] + part['m2'] + delta ** 2 * total['count'] * weight,
+    })
+
+def so2_daily_totals(rows):
+    # Q1 batch step: SO2 sum and count per station and day, over the measurement
+    # rows whose SO2 instrument status is 0
+    merged = rows.dropna(subset=['SO2'])
+    # Integer day number (days since the epoch) as the daily key, instead of
+    # building a Python date object per row; packed with the station into one
+    # int64 so both totals come from bincounts over a single set of group ids
+    day = merged['Measurement date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+    keys = (merged['Station code'].to_numpy().astype(np.int64) << 32) + day
+    uniq, group = np.unique(keys, return_inverse=True)
+    return pd.DataFrame({
+        'sum': np.bincount(group, weights=merged['SO2'].to_numpy(), minlength=len(uniq)),
+        'count': np.bincount(group, minlength=len(uniq)),
+    }, index=uniq)
+
+def co_seasonal_totals(rows):
+    # Q2 batch step: CO sum and count per season at station 209, over the rows
+    # whose CO instrument status is 0, as two length-4 arrays indexed by season
+    # number minus one
+    merged = rows[rows['Station code'] == 209].dropna(subset=['CO'])
+    seasons = SEASON_INDEX_BY_MONTH[merged['Measurement date'].dt.month.to_numpy()]
+    sums = np.bincount(seasons, weights=merged['CO'].to_numpy(), minlength=4)
+    counts = np.bincount(seasons, minlength=4)
+    return sums, counts
+
+def o3_hourly_moments(rows):
+    # Q3 batch step: O3 (count, mean, m2) per hour, over the rows whose O3
+    # instrument status is 0
+    merged = rows.dropna(subset=['O3'])
+    hours = merged['Measurement date'].dt.hour.to_numpy()
+    o3 = merged['O3'].to_numpy(dtype=np.float64)
+    # All 24 hours are reduced together by bincounts over the hour array; m2 is
+    # summed from deviations about each hour's batch mean rather than from raw
+    # squares, which keeps the variance free of cancellation error
+    count = np.bincount(hours, minlength=24)
+    mean = np.divide(np.bincount(hours, weights=o3, minlength=24), count,
+                     out=np.zeros(24), where=count > 0)
+    m2 = np.bincount(hours, weights=(o3 - mean[hours]) ** 2, minlength=24)
+    return pd.DataFrame({'count': count, 'mean': mean, 'm2': m2},
+                        index=pd.RangeIndex(24, name='hour'))
+
+def pm25_category_counts(rows, thresholds):
+    # Q6 batch step: PM2.5 record counts per quality category, over the rows
+    # whose PM2.5 instrument status is 0
+    merged = rows.dropna(subset=['PM2.5'])
+    pm25 = merged['PM2.5'].to_numpy()
+    # Bucket 0..3 per row in one pass: with side='left' a value equal to a
+    # threshold falls in the lower category, matching the inclusive upper
+    # bounds; thresholds take the data's dtype, as the scalar comparisons did
+    edges = np.asarray(thresholds, dtype=pm25.dtype)
+    buckets = np.searchsorted(edges, pm25, side='left')
+    return np.bincount(buckets, minlength=4)
+
+@lru_cache(maxsize=None)
+def read_pollutant_info(path, mtime):
+    # Read the pollutant table, keeping only the columns the questions use: item
+    # codes by name and (Good, Normal, Bad) thresholds by name. Memoized per file
+    # path and modification time, as in anomaly_detection.py; errors propagate and
+    # are not cached. Missing threshold columns are returned rather than raised,
+    # since only Q6 needs them
+    df = pd.read_csv(path, usecols=lambda c: c.strip() in POLLUTANT_INFO_COLUMNS)
+    # Trim whitespace in column names
+    df.columns = [c.strip() for c in df.columns]
+    names = df['Item name'].tolist()
+    codes = dict(zip(names, df['Item code'].tolist()))
+    threshold_cols = ['Good', 'Normal', 'Bad']
+    missing_cols = sorted(set(threshold_cols) - set(df.columns))
+    thresholds = {} if missing_cols else dict(zip(names, df[threshold_cols].itertuples(index=False, name=None)))
+    return codes, thresholds, missing_cols
+
+def load_pollutant_info():
+    # Pollutant codes and thresholds as fresh dicts, so callers never change the
+    # memo; compute_task1 loads them once per run
     try:
-        df = pd.read_csv(POLLUTANT_FILE)
-        # Assume columns 'Item name' and 'Item code' exist; trim whitespace in column names
-        df.columns = [c.strip() for c in df.columns]
-        return df.set_index('Item name')['Item code'].to_dict()
+        codes, thresholds, missing_cols = read_pollutant_info(POLLUTANT_FILE, os.path.getmtime(POLLUTANT_FILE))
     except Exception as e:
         print("Error loading pollutant data:", e)
-        return {}
+        return {'codes': {}, 'thresholds': {}}
+    # Thresholds are only needed by Q6; without them the other questions still run
+    if missing_cols:
+        print("Error loading pollutant thresholds: missing columns", missing_cols)
+    return {'codes': dict(codes), 'thresholds': dict(thresholds)}
 
 def compute_task1():
-    # Load measurement data
+    # Load measurement data; it is streamed from the Parquet cache in batches,
+    # reading only the key columns and the pollutants the questions use
+    key_cols = ['Station code', 'Measurement date']
     try:
-        df_measure = pd.read_csv(MEASUREMENT_FILE, parse_dates=["Measurement date"])
+        measure_batches = iter_cached_batches(MEASUREMENT_FILE, preprocess_measurement_data,
+                                              MEASUREMENT_CSV_OPTIONS, columns=key_cols + ['SO2', 'CO', 'O3', 'PM2.5'])
     except Exception as e:
         print("Error loading measurement data:", e)
         return {}
-    df_measure = preprocess_measurement_data(df_measure)
     
-    # Load instrument data
+    # Load instrument data, skipping columns no question reads
     try:
-        df_instrument = pd.read_csv(INSTRUMENT_FILE, parse_dates=["Measurement date"])
+        df_instrument = cached_load(INSTRUMENT_FILE, preprocess_instrument_data, INSTRUMENT_COLUMN_TYPES,
+                                    __file__, columns=key_cols + ['Item code', 'Instrument status'])
     except Exception as e:
         print("Error loading instrument data:", e)
         return {}
-    df_instrument = preprocess_instrument_data(df_instrument)
     
-    pollutant_map = load_pollutant_mapping()
+    pollutant_info = load_pollutant_info()
+    pollutant_map = pollutant_info['codes']
+    so2_code = pollutant_map.get('SO2')
+    co_code = pollutant_map.get('CO')
+    o3_code = pollutant_map.get('O3')
+    pm25_code = pollutant_map.get('PM2.5')
+    
+    # Status-0 instrument rows, filtered once; each pollutant's (station, timestamp)
+    # pairs become a sorted array of unique keys, built once, so every batch is
+    # semi-joined against them by binary search instead of materializing a merged frame
+    valid = df_instrument.loc[df_instrument['Instrument status'] == 0, key_cols + ['Item code']]
+    # Keys and item codes are extracted once; each pollutant then takes its rows
+    # by position instead of filtering the frame again
+    valid_all_keys = station_time_keys(valid)
+    valid_items = valid['Item code'].to_numpy(dtype=np.int32, na_value=-1)
+    valid_keys = {code: np.unique(valid_all_keys.take(np.flatnonzero(valid_items == code)))
+                  for code in (so2_code, co_code, o3_code, pm25_code) if code is not None}
+    
+    # PM2.5 quality thresholds for Q6, needed before the batches are scanned
+    pm25_thresholds = pollutant_info['thresholds'].get('PM2.5') if pm25_code is not None else None
+    
+    # Running aggregates, updated once per measurement batch
+    so2_daily = pd.DataFrame(columns=['sum', 'count'], dtype=float)
+    co_sums = np.zeros(4)
+    co_counts = np.zeros(4, dtype=np.int64)
+    o3_hourly = pd.DataFrame(0.0, index=pd.RangeIndex(24, name='hour'), columns=['count', 'mean', 'm2'])
+    pm25_counts = np.zeros(4, dtype=np.int64)
+    
+    # The per-batch steps of Q1, Q2, Q3 and Q6 are independent and spend most of
+    # their time in pandas/numpy kernels that release the GIL, so they run on a
+    # thread pool; the running aggregates are only updated on this thread
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for df_measure in measure_batches:
+            # Semi-join: keep the batch rows whose key has a status-0 reading
+            # of the question's pollutant
+            batch_keys = station_time_keys(df_measure)
+            
+            steps = {}
+            if so2_code is not None:
+                steps['Q1'] = executor.submit(so2_daily_totals, df_measure[sorted_isin(batch_keys, valid_keys[so2_code])])
+            if co_code is not None:
+                steps['Q2'] = executor.submit(co_seasonal_totals, df_measure[sorted_isin(batch_keys, valid_keys[co_code])])
+            if o3_code is not None:
+                steps['Q3'] = executor.submit(o3_hourly_moments, df_measure[sorted_isin(batch_keys, valid_keys[o3_code])])
+            if pm25_thresholds is not None:
+                steps['Q6'] = executor.submit(pm25_category_counts, df_measure[sorted_isin(batch_keys, valid_keys[pm25_code])], pm25_thresholds)
+            
+            if 'Q1' in steps:
+                daily = steps['Q1'].result()
+                so2_daily = daily.add(so2_daily, fill_value=0) if not so2_daily.empty else daily
+            if 'Q2' in steps:
+                sums, counts = steps['Q2'].result()
+                co_sums += sums
+                co_counts += counts
+            if 'Q3' in steps:
+                o3_hourly = merge_moments(o3_hourly, steps['Q3'].result())
+            if 'Q6' in steps:
+                pm25_counts += steps['Q6'].result()
     
     # Q1: Average daily SO2 concentration across all stations.
     q1 = 0.0
-    so2_code = pollutant_map.get('SO2')
-    if so2_code is not None:
-        # Filter instrument data for SO2 when status is 0
-        instr_so2 = df_instrument[(df_instrument['Item code'] == so2_code) & (df_instrument['Instrument status'] == 0)]
-        # Merge on Station code and Measurement date
-        merged = pd.merge(df_measure, instr_so2[['Station code', 'Measurement date']], 
-                          on=['Station code', 'Measurement date'], how='inner')
-        merged = merged.dropna(subset=['SO2'])
-        if not merged.empty:
-            # Group by Station code and date
-            daily_avg = merged.groupby(['Station code', merged['Measurement date'].dt.date])['SO2'].mean()
-            q1 = round(daily_avg.mean(), 5)
+    if not so2_daily.empty:
+        daily_avg = so2_daily['sum'] / so2_daily['count']
+        q1 = round(float(daily_avg.mean()), 5)
     
     # Q2: Average CO per season at station 209.
     q2 = {"1": 0.0, "2": 0.0, "3": 0.0, "4": 0.0}
-    co_code = pollutant_map.get('CO')
-    if co_code is not None:
-        instr_co = df_instrument[(df_instrument['Item code'] == co_code) & (df_instrument['Instrument status'] == 0)]
-        merged = pd.merge(df_measure, instr_co[['Station code', 'Measurement date']], 
-                          on=['Station code', 'Measurement date'], how='inner')
-        merged = merged[merged['Station code'] == 209].dropna(subset=['CO'])
-        if not merged.empty:
-            merged['month'] = merged['Measurement date'].dt.month
-            merged['season'] = merged['month'].apply(get_season)
-            q2 = merged.groupby('season')['CO'].mean().round(5).to_dict()
-            # Convert numpy numbers to Python floats
-            q2 = {k: float(v) for k, v in q2.items()}
+    if co_counts.any():
+        # Only seasons with data are reported; convert numpy numbers to Python
+        # floats before rounding
+        q2 = {str(i + 1): round(float(co_sums[i] / co_counts[i]), 5)
+              for i in np.flatnonzero(co_counts)}
     
     # Q3: Hour with highest variability (standard deviation) for O3.
     q3 = 0
-    o3_code = pollutant_map.get('O3')
-    if o3_code is not None:
-        instr_o3 = df_instrument[(df_instrument['Item code'] == o3_code) & (df_instrument['Instrument status'] == 0)]
-        merged = pd.merge(df_measure, instr_o3[['Station code', 'Measurement date']], 
-                          on=['Station code', 'Measurement date'], how='inner')
-        merged = merged.dropna(subset=['O3'])
-        if not merged.empty:
-            merged['hour'] = merged['Measurement date'].dt.hour
-            q3 = int(merged.groupby('hour')['O3'].std().idxmax())
+    if o3_hourly['count'].sum() > 0:
+        o3_var = o3_hourly['m2'] / (o3_hourly['count'] - 1).where(o3_hourly['count'] > 1)
+        q3 = int(o3_var.idxmax())
+    
+    # Station codes are small non-negative integers, so per-station record counts
+    # for Q4 and Q5 are a single np.bincount over the selected codes
+    station_codes = df_instrument['Station code'].to_numpy(dtype=np.int32)
+    status = df_instrument['Instrument status'].to_numpy()
     
     # Q4: Station with most 'Abnormal data' (Instrument status 9)
-    abnormal = df_instrument[df_instrument['Instrument status'] == 9]
-    q4 = int(abnormal['Station code'].value_counts().idxmax()) if not abnormal.empty else None
+    abnormal = station_codes[status == 9]
+    q4 = int(np.bincount(abnormal).argmax()) if abnormal.size else None
     
     # Q5: Station with most 'not normal' measurements (Instrument status != 0)
-    not_normal = df_instrument[df_instrument['Instrument status'] != 0]
-    q5 = int(not_normal['Station code'].value_counts().idxmax()) if not not_normal.empty else None
+    not_normal = station_codes[status != 0]
+    q5 = int(np.bincount(not_normal).argmax()) if not_normal.size else None
     
     # Q6: Count PM2.5 records by quality category.
-    q6 = {"Good": 0, "Normal": 0, "Bad": 0, "Very bad": 0}
-    pm25_code = pollutant_map.get('PM2.5')
-    if pm25_code is not None:
-        try:
-            pm25_info = pd.read_csv(POLLUTANT_FILE)
-            pm25_info.columns = [c.strip() for c in pm25_info.columns]
-        except Exception as e:
-            print("Error re-loading pollutant data for Q6:", e)
-            pm25_info = pd.DataFrame()
-        if not pm25_info.empty and 'Item name' in pm25_info.columns:
-            pm25_row = pm25_info[pm25_info['Item name'] == 'PM2.5']
-            if not pm25_row.empty:
-                pm25_row = pm25_row.iloc[0]
-                good = pm25_row['Good']
-                normal = pm25_row['Normal']
-                bad = pm25_row['Bad']
-                # Filter instrument data for PM2.5 when status is 0
-                instr_pm25 = df_instrument[(df_instrument['Item code'] == pm25_code) & 
-                                           (df_instrument['Instrument status'] == 0)]
-                merged = pd.merge(df_measure, instr_pm25[['Station code', 'Measurement date']], 
-                                  on=['Station code', 'Measurement date'], how='inner')
-                merged = merged.dropna(subset=['PM2.5'])
-                pm25 = merged['PM2.5']
-                q6 = {
-                    "Good": int(((pm25 <= good)).sum()),
-                    "Normal": int(((pm25 > good) & (pm25 <= normal)).sum()),
-                    "Bad": int(((pm25 > normal) & (pm25 <= bad)).sum()),
-                    "Very bad": int(((pm25 > bad)).sum())
-                }
+    q6 = dict(zip(["Good", "Normal", "Bad", "Very bad"], pm25_counts.tolist()))
     
     # Ensure that all numpy types are converted to native Python types
     result = {